@@ -22,116 +22,502 @@
 
 """
 
+from collections import OrderedDict
 from cython.parallel import prange
+import hashlib
+import os
+
 import numpy as np
 import scipy.fft as fft
 cimport cython
 cimport numpy as np
-from skimage.registration._phase_cross_correlation import _upsampled_dft
+cimport openmp
+from libc.math cimport fabs
+from libc.math cimport sqrt
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+from ..windows import gather_windows
+from ..windows import hann_window
+from ..windows import no_data_windows
+from ..windows import shift_magnitudes
+from ..windows import strided_windows
+from ..windows import window_batches
+from ..windows import window_groups
 
 np.import_array()
 
-DTYPE = np.int16
+ctypedef fused raster_t:
+    short
+    float
+    double
+
+ctypedef fused sample_t:
+    float
+    double
+
+ctypedef fused spectrum_t:
+    float complex
+    double complex
+
+# Window precision, `SINGLE_DTYPE` when `single_precision`
+DTYPE = np.float64
+SINGLE_DTYPE = np.float32
+
+# Upper bound on elements held by one batch of windows
+MAX_BATCH_ELEMENTS = 2 ** 20
+
+# `scipy.fft` / FFTW threads per batch, -1 for all cores
+FFT_WORKERS = -1
+
+# FFTW plan pairs by batch shape and dtype, least recently used first.
+# Only used when `pyfftw` is installed, for batches not filtered by `no_data`
+FFTW_PLANS = OrderedDict()
+FFTW_PLANS_SIZE = 8
+FFTW_PLANNER_FLAGS = ("FFTW_ESTIMATE",)
+
+# Conjugate moving spectra reused across references when `cache_moving_spectra`,
+# least recently used first
+MOVING_SPECTRA_CACHE = OrderedDict()
+MOVING_SPECTRA_CACHE_SIZE = 4
+
+# Byte budget shared by all cached moving spectra, larger spectra are never cached
+MAX_CACHED_SPECTRA_BYTES = 2 ** 28
+
+
+def clear_fft_cache():
+    """
+    Empties `MOVING_SPECTRA_CACHE` and `FFTW_PLANS`
+
+    """
+
+    MOVING_SPECTRA_CACHE.clear()
+    FFTW_PLANS.clear()
+
+
+def set_num_threads(int threads):
+    """
+    Limits `scipy.fft` workers, new FFTW plans and OpenMP loops to `threads`,
+    -1 for all cores
+
+    """
+
+    global FFT_WORKERS
+
+    FFT_WORKERS = threads
+    FFTW_PLANS.clear()
+    openmp.omp_set_num_threads(os.cpu_count() if threads == -1 else threads)
+
+
+cdef Py_ssize_t cached_spectra_bytes():
+    """
+    Returns the bytes held by `MOVING_SPECTRA_CACHE`
+
+    """
+
+    return sum(spectrum.nbytes for spectra in MOVING_SPECTRA_CACHE.values() for spectrum in spectra)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void peak_shifts(sample_t[:, :, ::1] cross_correlation, double[:, ::1] shifts,
+                      bint subpixel=False) nogil:
+    """
+    Writes the wrapped `(row, col)` peak of each `|cross_correlation|` window to `shifts`
+
+    If `subpixel`, each axis is refined by a 3-point parabolic fit through the
+    peak and its periodic neighbours. Windows are independent and split
+    statically across OpenMP threads
+
+    """
+
+    cdef Py_ssize_t n_windows = cross_correlation.shape[0]
+    cdef Py_ssize_t rows = cross_correlation.shape[1]
+    cdef Py_ssize_t cols = cross_correlation.shape[2]
+    cdef Py_ssize_t window, row, col, peak_row, peak_col
+    cdef double peak, value, before, after, curvature
+
+    for window in prange(n_windows, schedule="static"):
+        peak = -1.0
+        peak_row = 0
+        peak_col = 0
+
+        for row in range(rows):
+            for col in range(cols):
+                value = fabs(cross_correlation[window, row, col])
+                if value > peak:
+                    peak = value
+                    peak_row = row
+                    peak_col = col
+
+        shifts[window, 0] = peak_row - rows if peak_row > rows / 2 else peak_row
+        shifts[window, 1] = peak_col - cols if peak_col > cols / 2 else peak_col
+
+        if subpixel:
+            before = fabs(cross_correlation[window, (peak_row - 1 + rows) % rows, peak_col])
+            after = fabs(cross_correlation[window, (peak_row + 1) % rows, peak_col])
+            curvature = before - 2 * peak + after
+            if curvature != 0:
+                shifts[window, 0] += 0.5 * (before - after) / curvature
+
+            before = fabs(cross_correlation[window, peak_row, (peak_col - 1 + cols) % cols])
+            after = fabs(cross_correlation[window, peak_row, (peak_col + 1) % cols])
+            curvature = before - 2 * peak + after
+            if curvature != 0:
+                shifts[window, 1] += 0.5 * (before - after) / curvature
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def cross_power(spectrum_t[:, :, ::1] src_freq, spectrum_t[:, :, ::1] target_freq_conj,
+                spectrum_t[:, :, ::1] image_product, bint normalize=False):
+    """
+    Writes `src_freq * target_freq_conj` to `image_product` in one pass, scaled to
+    unit magnitude if `normalize`. `image_product` may be `src_freq` itself.
+    Windows are split across OpenMP threads
+
+    """
+
+    cdef Py_ssize_t n_windows = src_freq.shape[0]
+    cdef Py_ssize_t rows = src_freq.shape[1]
+    cdef Py_ssize_t cols = src_freq.shape[2]
+    cdef Py_ssize_t window, row, col
+    cdef double real, imag, scale
+
+    for window in prange(n_windows, nogil=True, schedule="static"):
+        for row in range(rows):
+            for col in range(cols):
+                real = (
+                    src_freq[window, row, col].real * target_freq_conj[window, row, col].real
+                    - src_freq[window, row, col].imag * target_freq_conj[window, row, col].imag
+                )
+                imag = (
+                    src_freq[window, row, col].real * target_freq_conj[window, row, col].imag
+                    + src_freq[window, row, col].imag * target_freq_conj[window, row, col].real
+                )
+
+                if normalize:
+                    scale = 1.0 / sqrt(real * real + imag * imag + 1e-12)
+                    real = real * scale
+                    imag = imag * scale
+
+                image_product[window, row, col] = real + imag * 1j
+
+
+cdef fftw_plans(shape, dtype):
+    """
+    Returns the cached `(forward, inverse)` FFTW plans for `shape` real windows of `dtype`
+
+    """
 
-cdef find_shift(int[:, :] reference_image, int[:, :] moving_image,
-                            int upsample=1,
-                            double overlap_ratio=0.3):
+    key = (shape, np.dtype(dtype).str)
+    if key in FFTW_PLANS:
+        FFTW_PLANS.move_to_end(key)
+        return FFTW_PLANS[key]
 
-    src_freq = fft.fftn(reference_image)
-    target_freq = fft.fftn(moving_image)
-    image_product = src_freq * target_freq.conj()
-    cross_correlation = fft.ifftn(image_product)
+    threads = os.cpu_count() if FFT_WORKERS == -1 else FFT_WORKERS
+    windows = pyfftw.empty_aligned(shape, dtype=dtype)
+    spectrum = pyfftw.empty_aligned(
+        shape[:2] + (shape[2] // 2 + 1,), dtype=np.result_type(dtype, np.complex64)
+    )
 
-    cdef Py_ssize_t cc_x, cc_y
+    FFTW_PLANS[key] = (
+        pyfftw.FFTW(
+            windows, spectrum, axes=(1, 2), threads=threads, flags=FFTW_PLANNER_FLAGS
+        ),
+        pyfftw.FFTW(
+            spectrum,
+            windows,
+            axes=(1, 2),
+            direction="FFTW_BACKWARD",
+            threads=threads,
+            flags=FFTW_PLANNER_FLAGS + ("FFTW_DESTROY_INPUT",),
+        ),
+    )
+    while len(FFTW_PLANS) > FFTW_PLANS_SIZE:
+        FFTW_PLANS.popitem(last=False)
 
-    cc_x = cross_correlation.shape[0]
-    cc_y = cross_correlation.shape[1]
+    return FFTW_PLANS[key]
 
-    cdef Py_ssize_t src_freq_x = reference_image.shape[0]
-    cdef Py_ssize_t  src_freq_y = reference_image.shape[1]
 
-    maxima = np.unravel_index(np.argmax(np.abs(cross_correlation)),(cc_x, cc_y))      
-    midpoints = np.array([np.fix(axis_size / 2) for axis_size in (src_freq_x, src_freq_y)])
-    
-    shifts = np.stack(maxima).astype(np.float64)
-    shifts[shifts > midpoints] -= np.array((src_freq_x, src_freq_y))[shifts > midpoints]
+cdef forward_fft(windows, bint planned=True):
+    """
+    Returns the half spectrum of `(n_windows, rows, cols)` real windows.
+    Unless `planned`, `scipy.fft` is used so filtered batches don't build FFTW plans
 
-    if upsample > 1:
+    """
 
-        shifts = np.round(shifts * upsample) / upsample
-        upsampled_region_size = np.ceil(upsample * 1.5)
-       
-        dftshift = np.fix(upsampled_region_size / 2.0)
-        upsample = np.array(upsample, dtype=np.float64)
+    if pyfftw is None or not planned:
+        return fft.rfftn(windows, axes=(1, 2))
 
-        sample_region_offset = dftshift - shifts * upsample
-        cross_correlation = _upsampled_dft(image_product.conj(),
-                                           upsampled_region_size,
-                                           upsample,
-                                           sample_region_offset).conj()
+    forward = fftw_plans(windows.shape, windows.dtype)[0]
+    spectrum = pyfftw.empty_aligned(forward.output_shape, dtype=forward.output_dtype)
 
-        maxima = np.unravel_index(np.argmax(np.abs(cross_correlation)),
-                                  cross_correlation.shape)
-        CCmax = cross_correlation[maxima]
+    return forward(windows, spectrum)
 
-        maxima = np.stack(maxima).astype(np.float64) - dftshift
 
-        shifts = shifts + maxima / upsample
-    
-    for dim in range(src_freq.ndim):
-        if (src_freq_x, src_freq_y)[dim] == 1:
-            shifts[dim] = 0
+cdef inverse_fft(spectrum, Py_ssize_t rows, Py_ssize_t cols, bint planned=True):
+    """
+    Returns `(n_windows, rows, cols)` real windows from their half spectrum.
+    With FFTW, `spectrum` is overwritten
+
+    """
+
+    if pyfftw is None or not planned:
+        return fft.irfftn(spectrum, s=(rows, cols), axes=(1, 2))
+
+    inverse = fftw_plans((spectrum.shape[0], rows, cols), spectrum.real.dtype)[1]
+    windows = pyfftw.empty_aligned(inverse.output_shape, dtype=inverse.output_dtype)
+
+    return inverse(spectrum, windows)
+
+
+cdef moving_spectrum(moving_windows, bint planned=True):
+    """
+    Returns the conjugate half spectrum of `(n_windows, rows, cols)` moving windows
+
+    """
+
+    spectrum = forward_fft(moving_windows, planned)
+
+    return np.conjugate(spectrum, out=spectrum)
+
+
+cdef find_shifts(reference_windows, target_freq_conj, int upsample=1, bint normalize=False,
+                 bint subpixel=False, bint planned=True):
+    """
+    Returns shift magnitude for each `(n_windows, rows, cols)` reference window
+    against the matching conjugate moving spectrum. `upsample > 1` takes
+    precedence over `subpixel`
+
+    """
+
+    cdef Py_ssize_t n_windows = reference_windows.shape[0]
+    cdef Py_ssize_t rows = reference_windows.shape[1]
+    cdef Py_ssize_t cols = reference_windows.shape[2]
+    cdef float[:, :, ::1] single_view
+    cdef double[:, :, ::1] double_view
+
+    # Cross-power is formed in place over the reference spectrum
+    image_product = forward_fft(reference_windows, planned)
+    cross_power(image_product, target_freq_conj, image_product, normalize)
+    cross_correlation = np.ascontiguousarray(
+        inverse_fft(
+            image_product.copy() if upsample > 1 else image_product, rows, cols, planned
+        )
+    )
+
+    shifts = np.empty((n_windows, 2), dtype=np.float64)
+    cdef double[:, ::1] shifts_view = shifts
+    cdef bint parabolic = subpixel and upsample <= 1
+
+    if cross_correlation.dtype == SINGLE_DTYPE:
+        single_view = cross_correlation
+        with nogil:
+            peak_shifts(single_view, shifts_view, parabolic)
+    else:
+        double_view = cross_correlation
+        with nogil:
+            peak_shifts(double_view, shifts_view, parabolic)
+
+    return shift_magnitudes(shifts, image_product, rows, cols, upsample)
 
-    return shifts
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def phase_cross_correlation(int[:, :] reference_arr, int[:, :] moving_arr, int window_size = 64, 
-    int window_step = 64, double no_data = -9999., int upsample = 1):
-    
+@cython.cdivision(True)
+cdef void gather_shifts(double[:, ::1] window_shift, double[:, ::1] out, int window_step,
+                        int window_length, double no_data) nogil:
+    """
+    Writes each pixel of `out` from its covering window, the last window written wins
+
+    Pixels past the last window's footprint are `no_data`. Rows are split across
+    OpenMP threads
+
+    """
+
+    cdef Py_ssize_t n_x = window_shift.shape[0]
+    cdef Py_ssize_t n_y = window_shift.shape[1]
+    cdef Py_ssize_t row, col, row_window, col_window
+
+    for row in prange(out.shape[0], schedule="static"):
+        row_window = min(row // window_step, n_x - 1)
+
+        for col in range(out.shape[1]):
+            col_window = min(col // window_step, n_y - 1)
+
+            if (
+                row >= row_window * window_step + window_length
+                or col >= col_window * window_step + window_length
+            ):
+                out[row, col] = no_data
+            else:
+                out[row, col] = window_shift[row_window, col_window]
+
+
+def phase_cross_correlation(raster_t[:, :] reference_arr, raster_t[:, :] moving_arr, int window_size = 64,
+    int window_step = 64, double no_data = -9999., int upsample = 1, bint hann = False,
+    bint normalize = False, bint subpixel = False, bint single_precision = False,
+    bint cache_moving_spectra = False, double[:, ::1] out = None):
+    """
+    Sliding window phase cross correlation of `reference_arr` against `moving_arr`,
+    both int16, float32 or float64
+
+    Windows are gathered into `(n_windows, window_size, window_size)` stacks and
+    correlated with one batched rFFT per stack. Each window writes its shift
+    magnitude over its footprint, later windows overwriting earlier ones.
+    If `hann`, both stacks are tapered with a cached Hann window first. If
+    `normalize`, the cross-power spectrum is scaled to unit magnitude. If
+    `subpixel`, peaks are refined by a parabolic fit instead of upsampling.
+    If `single_precision`, windows are transformed as float32 / complex64.
+
+    Windows holding any `no_data` pixel in either image are found from integral
+    images of the `no_data` masks and set to `no_data` without being transformed.
+
+    If `cache_moving_spectra`, conjugate moving spectra are cached by content within
+    `MAX_CACHED_SPECTRA_BYTES`, so correlating one moving image against several
+    references transforms it once. See `clear_fft_cache`
+
+    Results are written to `out` if given, else to a new float64 array
+
+    """
+
     cdef Py_ssize_t x_max = reference_arr.shape[0]
     cdef Py_ssize_t y_max = reference_arr.shape[1]
+    cdef int window_start = window_size // 2
+
+    reference = np.asarray(reference_arr)
+    moving = np.asarray(moving_arr)
+    dtype = SINGLE_DTYPE if single_precision else DTYPE
+
+    if out is None:
+        out = np.empty((x_max, y_max), dtype=np.float64)
+    elif out.shape[0] != x_max or out.shape[1] != y_max:
+        raise ValueError(f"`out` must be shaped {(x_max, y_max)}")
+
+    x_groups = window_groups(x_max, window_start, window_step)
+    y_groups = window_groups(y_max, window_start, window_step)
+
+    if not x_groups or not y_groups:
+        out[:, :] = no_data
+        return np.asarray(out)
+
+    cdef Py_ssize_t n_x = x_groups[-1][1]
+    cdef Py_ssize_t n_y = y_groups[-1][1]
+
+    window_shift = np.empty((n_x, n_y), dtype=np.float64)
+
+    ## Windows touching `no_data` in either image are never transformed
+    skip = no_data_windows((reference, moving), no_data, x_groups, y_groups, window_step)
+
+    cached_spectra = None
+    new_spectra = None
+
+    ## Upper bound on the spectra size, edge windows are smaller
+    if cache_moving_spectra and (
+        n_x * n_y * (2 * window_start) * (window_start + 1) * 2 * np.dtype(dtype).itemsize
+        <= MAX_CACHED_SPECTRA_BYTES
+    ):
+        cache_key = (
+            hashlib.blake2b(np.ascontiguousarray(moving)).digest(),
+            moving.shape,
+            moving.dtype.str,
+            window_size,
+            window_step,
+            hann,
+            single_precision,
+        )
+        cached_spectra = MOVING_SPECTRA_CACHE.get(cache_key)
+
+        if cached_spectra is not None:
+            MOVING_SPECTRA_CACHE.move_to_end(cache_key)
+        else:
+            new_spectra = []
+
+    cdef Py_ssize_t batch = 0
+
+    # Batches are C-contiguous so pocketfft can thread over the batch axis
+    with fft.set_workers(FFT_WORKERS):
+        for rows, cols, x_len, y_len in window_batches(x_groups, y_groups, MAX_BATCH_ELEMENTS):
+            shifts = window_shift[rows, cols]
+            taper = hann_window(x_len, y_len, dtype) if hann else None
+
+            keep = None
+            if skip is not None:
+                keep = ~skip[rows, cols]
+                if keep.all():
+                    keep = None
+
+            reference_stack = gather_windows(
+                strided_windows(reference, rows, cols, x_len, y_len, window_step), keep, dtype
+            )
+
+            if taper is not None:
+                reference_stack *= taper
+
+            ## Cache entries hold every window, so they are transformed unfiltered
+            if cached_spectra is not None:
+                target_freq_conj = cached_spectra[batch]
+            elif new_spectra is not None or reference_stack.shape[0] > 0:
+                moving_keep = keep if new_spectra is None else None
+                moving_stack = gather_windows(
+                    strided_windows(moving, rows, cols, x_len, y_len, window_step),
+                    moving_keep,
+                    dtype,
+                )
+
+                if taper is not None:
+                    moving_stack *= taper
 
-    # assert tuple(reference_arr.shape) == tuple(moving_arr.shape)
+                target_freq_conj = moving_spectrum(moving_stack, moving_keep is None)
 
-    cdef np.ndarray total_shift = no_data * np.ones((x_max, y_max), dtype=DTYPE)
-    total_shift = no_data * np.ones((x_max, y_max), dtype=DTYPE)
-    cdef double[:,:] total_shift_view = total_shift
+                if new_spectra is not None:
+                    new_spectra.append(target_freq_conj)
 
-    cdef int window_start = window_size / 2
+            batch += 1
 
-    cdef int[:] x_arrange = np.arange(window_start, x_max, window_step, dtype=DTYPE).astype('intc')
-    cdef int[:] y_arrange = np.arange(window_start, y_max, window_step, dtype=DTYPE).astype('intc')
+            if keep is None:
+                shifts[:, :] = find_shifts(
+                    reference_stack,
+                    target_freq_conj,
+                    upsample=upsample,
+                    normalize=normalize,
+                    subpixel=subpixel,
+                ).reshape(shifts.shape)
+                continue
 
-    cdef Py_ssize_t x, y
-    cdef int row_start, row_end
-    cdef int col_start, col_end
-    cdef int[:,:] reference_window, moving_window
-    cdef double[:] offset_pixels_view
-    cdef double offset_x, offset_y
+            shifts[:, :] = no_data
+            if reference_stack.shape[0] == 0:
+                continue
 
-    for x in x_arrange:
-        for y in y_arrange:
+            if target_freq_conj.shape[0] != reference_stack.shape[0]:
+                target_freq_conj = target_freq_conj[keep.ravel()]
 
-            row_start = x - window_start
-            row_end = x + window_start
-            col_start = y - window_start
-            col_end = y + window_start
-            
-            reference_window = reference_arr[row_start:row_end, col_start:col_end]
-            moving_window = moving_arr[row_start:row_end, col_start:col_end]
+            shifts[keep] = find_shifts(
+                reference_stack,
+                target_freq_conj,
+                upsample=upsample,
+                normalize=normalize,
+                subpixel=subpixel,
+                planned=False,
+            )
 
-            offset_pixels = find_shift(reference_window, moving_window, upsample=upsample)
-            offset_pixels_view = offset_pixels
+    if new_spectra is not None:
+        MOVING_SPECTRA_CACHE[cache_key] = new_spectra
+        while (
+            len(MOVING_SPECTRA_CACHE) > MOVING_SPECTRA_CACHE_SIZE
+            or cached_spectra_bytes() > MAX_CACHED_SPECTRA_BYTES
+        ):
+            MOVING_SPECTRA_CACHE.popitem(last=False)
 
-            # TODO
-            # When not dealing with subpixel shifts,
-            # we can deal with int type only
-            # loss of < 1/100th precision, slight speed+
+    cdef double[:, ::1] window_shift_view = window_shift
 
-            offset_x = offset_pixels_view[0]
-            offset_y = offset_pixels_view[1]
-            total_shift_view[row_start:row_end,col_start:col_end] = \
-                np.sqrt(1. * offset_y * offset_y + offset_x * offset_x, dtype=np.double)
+    with nogil:
+        gather_shifts(window_shift_view, out, window_step, 2 * window_start, no_data)
 
-    return total_shift
\ No newline at end of file
+    return np.asarray(out)
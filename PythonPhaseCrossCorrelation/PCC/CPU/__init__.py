@@ -1 +1,3 @@
+from .OptimizedPhaseCrossCorrelation import clear_fft_cache
 from .OptimizedPhaseCrossCorrelation import phase_cross_correlation
+from .OptimizedPhaseCrossCorrelation import set_num_threads
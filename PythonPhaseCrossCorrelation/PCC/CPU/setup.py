@@ -9,12 +9,27 @@
 
 from distutils.core import Extension
 from distutils.core import setup
+import sys
 
 from Cython.Build import cythonize
 import numpy
 
 sourcefiles = ["OptimizedPhaseCrossCorrelation.pyx"]
 
-extensions = [Extension("OptimizedPhaseCrossCorrelation", sourcefiles)]
+if sys.platform == "win32":
+    compile_args = ["/openmp", "/O2"]
+    link_args = []
+else:
+    compile_args = ["-fopenmp", "-O3", "-march=native", "-ffast-math"]
+    link_args = ["-fopenmp"]
+
+extensions = [
+    Extension(
+        "OptimizedPhaseCrossCorrelation",
+        sourcefiles,
+        extra_compile_args=compile_args,
+        extra_link_args=link_args,
+    )
+]
 
 setup(ext_modules=cythonize(extensions), include_dirs=[numpy.get_include()])
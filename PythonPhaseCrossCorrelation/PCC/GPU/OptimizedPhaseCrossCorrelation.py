@@ -0,0 +1,217 @@
+"""
+Mirrors `PCC.CPU.OptimizedPhaseCrossCorrelation` on the GPU with `cupy`.
+Window stacks are transformed with batched cuFFT plans; see the CPU module
+for algorithm references
+
+"""
+
+from typing import Optional
+
+import numpy as np
+
+from ..windows import gather_windows
+from ..windows import hann_window
+from ..windows import no_data_windows
+from ..windows import shift_magnitudes
+from ..windows import strided_windows
+from ..windows import window_batches
+from ..windows import window_groups
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# Window precision, `SINGLE_DTYPE` when `single_precision`
+DTYPE = np.float64
+SINGLE_DTYPE = np.float32
+
+# Upper bound on elements held by one batch of windows
+MAX_BATCH_ELEMENTS = 2**22
+
+# Compiled on first use
+_CROSS_POWER_KERNEL = None
+
+
+def _cross_power_kernel():
+    """
+    Returns the elementwise `src * conj_target` kernel, optionally unit magnitude
+
+    """
+    global _CROSS_POWER_KERNEL
+
+    if _CROSS_POWER_KERNEL is None:
+        _CROSS_POWER_KERNEL = cp.ElementwiseKernel(
+            "T src_freq, T target_freq_conj, bool normalize",
+            "T image_product",
+            """
+            image_product = src_freq * target_freq_conj;
+            if (normalize) {
+                image_product /= sqrt(norm(image_product) + 1e-12);
+            }
+            """,
+            "pcc_cross_power",
+        )
+
+    return _CROSS_POWER_KERNEL
+
+
+def _parabolic_offset(before, peak, after):
+    """
+    Vertex offset of the parabola through three equally spaced samples, `0` if flat
+
+    """
+    curvature = before - 2 * peak + after
+    flat = curvature == 0
+
+    return cp.where(flat, 0, 0.5 * (before - after) / cp.where(flat, 1, curvature))
+
+
+def _find_shifts(reference_windows, moving_windows, upsample, normalize, subpixel):
+    """
+    Returns shift magnitude for each `(n_windows, rows, cols)` window pair
+
+    """
+    n_windows, rows, cols = reference_windows.shape
+
+    # Cross-power is formed in place over the reference spectrum
+    image_product = cp.fft.rfft2(reference_windows, axes=(1, 2))
+    target_freq_conj = cp.fft.rfft2(moving_windows, axes=(1, 2)).conj()
+    _cross_power_kernel()(image_product, target_freq_conj, normalize, image_product)
+    cross_correlation = cp.fft.irfft2(image_product, s=(rows, cols), axes=(1, 2))
+
+    magnitude = cp.abs(cross_correlation)
+    maxima = magnitude.reshape(n_windows, -1).argmax(axis=1)
+    peak_row = maxima // cols
+    peak_col = maxima % cols
+
+    shifts = cp.stack(
+        (
+            cp.where(peak_row > rows // 2, peak_row - rows, peak_row),
+            cp.where(peak_col > cols // 2, peak_col - cols, peak_col),
+        ),
+        axis=1,
+    ).astype(cp.float64)
+
+    if subpixel and upsample <= 1:
+        window = cp.arange(n_windows)
+        peak = magnitude[window, peak_row, peak_col]
+
+        shifts[:, 0] += _parabolic_offset(
+            magnitude[window, (peak_row - 1) % rows, peak_col],
+            peak,
+            magnitude[window, (peak_row + 1) % rows, peak_col],
+        )
+        shifts[:, 1] += _parabolic_offset(
+            magnitude[window, peak_row, (peak_col - 1) % cols],
+            peak,
+            magnitude[window, peak_row, (peak_col + 1) % cols],
+        )
+
+    return shift_magnitudes(shifts, image_product, rows, cols, upsample, xp=cp)
+
+
+def phase_cross_correlation(
+    reference_arr: np.ndarray,
+    moving_arr: np.ndarray,
+    window_size: int = 64,
+    window_step: int = 64,
+    no_data: float = -9999.0,
+    upsample: int = 1,
+    hann: bool = False,
+    normalize: bool = False,
+    subpixel: bool = False,
+    single_precision: bool = False,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Sliding window phase cross correlation of `reference_arr` against `moving_arr` on the GPU
+
+    Same windowing and results as the CPU kernel, written to `out` if given.
+    Requires `cupy`
+
+    """
+    if cp is None:
+        raise ImportError("`cupy` must be installed for GPU processing")
+
+    x_max, y_max = reference_arr.shape
+    window_start = window_size // 2
+    dtype = SINGLE_DTYPE if single_precision else DTYPE
+
+    if out is None:
+        out = np.empty((x_max, y_max), dtype=np.float64)
+    elif out.shape != (x_max, y_max):
+        raise ValueError(f"`out` must be shaped {(x_max, y_max)}")
+
+    reference = cp.asarray(reference_arr, dtype=dtype)
+    moving = cp.asarray(moving_arr, dtype=dtype)
+
+    x_groups = window_groups(x_max, window_start, window_step)
+    y_groups = window_groups(y_max, window_start, window_step)
+
+    if not x_groups or not y_groups:
+        out[:] = no_data
+        return out
+
+    n_x = x_groups[-1][1]
+    n_y = y_groups[-1][1]
+
+    window_shift = cp.empty((n_x, n_y), dtype=cp.float64)
+
+    # Windows touching `no_data` in either image are never transformed
+    skip = no_data_windows(
+        (reference_arr, moving_arr), no_data, x_groups, y_groups, window_step
+    )
+    if skip is not None:
+        skip = cp.asarray(skip)
+
+    for rows, cols, x_len, y_len in window_batches(
+        x_groups, y_groups, MAX_BATCH_ELEMENTS
+    ):
+        shifts = window_shift[rows, cols]
+
+        keep = None
+        if skip is not None:
+            keep = ~skip[rows, cols]
+            shifts[~keep] = no_data
+            if not keep.any():
+                continue
+
+        reference_stack = gather_windows(
+            strided_windows(reference, rows, cols, x_len, y_len, window_step, xp=cp),
+            keep,
+            dtype,
+            xp=cp,
+        )
+        moving_stack = gather_windows(
+            strided_windows(moving, rows, cols, x_len, y_len, window_step, xp=cp),
+            keep,
+            dtype,
+            xp=cp,
+        )
+
+        if hann:
+            taper = cp.asarray(hann_window(x_len, y_len, dtype))
+            reference_stack *= taper
+            moving_stack *= taper
+
+        found = _find_shifts(
+            reference_stack, moving_stack, upsample, normalize, subpixel
+        )
+
+        if keep is None:
+            shifts[:] = found.reshape(shifts.shape)
+        else:
+            shifts[keep] = found
+
+    # Pixel -> covering window, the last window written wins
+    rows = cp.arange(x_max)
+    cols = cp.arange(y_max)
+    row_window = cp.minimum(rows // window_step, n_x - 1)
+    col_window = cp.minimum(cols // window_step, n_y - 1)
+
+    total_shift = window_shift[row_window[:, None], col_window[None, :]]
+    total_shift[rows >= row_window * window_step + 2 * window_start, :] = no_data
+    total_shift[:, cols >= col_window * window_step + 2 * window_start] = no_data
+
+    return total_shift.get(out=out)
@@ -0,0 +1,228 @@
+"""
+Mirrors `PCC.CPU.OptimizedPhaseCrossCorrelation` without a compile step.
+Batched FFTs run through `scipy.fft`; the cross-power product, peak search
+and raster gather are `numba` kernels. See the CPU module for algorithm
+references
+
+"""
+
+from typing import Optional
+
+from numba import njit
+from numba import prange
+import numpy as np
+import scipy.fft as fft
+
+from ..windows import gather_windows
+from ..windows import hann_window
+from ..windows import no_data_windows
+from ..windows import shift_magnitudes
+from ..windows import strided_windows
+from ..windows import window_batches
+from ..windows import window_groups
+
+# Window precision, `SINGLE_DTYPE` when `single_precision`
+DTYPE = np.float64
+SINGLE_DTYPE = np.float32
+
+# Upper bound on elements held by one batch of windows
+MAX_BATCH_ELEMENTS = 2**20
+
+# `scipy.fft` worker threads per batch, -1 for all cores
+FFT_WORKERS = -1
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _cross_power(image_product, target_freq_conj, normalize):
+    """
+    Multiplies `image_product` by `target_freq_conj` in place, scaled to unit
+    magnitude if `normalize`
+
+    """
+    for window in prange(image_product.shape[0]):
+        for row in range(image_product.shape[1]):
+            for col in range(image_product.shape[2]):
+                value = (
+                    image_product[window, row, col] * target_freq_conj[window, row, col]
+                )
+                if normalize:
+                    value = value / np.sqrt(
+                        value.real * value.real + value.imag * value.imag + 1e-12
+                    )
+                image_product[window, row, col] = value
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _peak_shifts(cross_correlation, shifts, subpixel):
+    """
+    Writes the wrapped `(row, col)` peak of each `|cross_correlation|` window to
+    `shifts`, refined by a 3-point parabolic fit if `subpixel`
+
+    """
+    rows = cross_correlation.shape[1]
+    cols = cross_correlation.shape[2]
+
+    for window in prange(cross_correlation.shape[0]):
+        peak = -1.0
+        peak_row = 0
+        peak_col = 0
+
+        for row in range(rows):
+            for col in range(cols):
+                value = abs(cross_correlation[window, row, col])
+                if value > peak:
+                    peak = value
+                    peak_row = row
+                    peak_col = col
+
+        shifts[window, 0] = peak_row - rows if peak_row > rows // 2 else peak_row
+        shifts[window, 1] = peak_col - cols if peak_col > cols // 2 else peak_col
+
+        if subpixel:
+            before = abs(
+                cross_correlation[window, (peak_row - 1 + rows) % rows, peak_col]
+            )
+            after = abs(cross_correlation[window, (peak_row + 1) % rows, peak_col])
+            curvature = before - 2 * peak + after
+            if curvature != 0:
+                shifts[window, 0] += 0.5 * (before - after) / curvature
+
+            before = abs(
+                cross_correlation[window, peak_row, (peak_col - 1 + cols) % cols]
+            )
+            after = abs(cross_correlation[window, peak_row, (peak_col + 1) % cols])
+            curvature = before - 2 * peak + after
+            if curvature != 0:
+                shifts[window, 1] += 0.5 * (before - after) / curvature
+
+
+@njit(parallel=True, cache=True)
+def _gather_shifts(window_shift, out, window_step, window_length, no_data):
+    """
+    Writes each pixel of `out` from its covering window, the last window written wins
+
+    """
+    n_x = window_shift.shape[0]
+    n_y = window_shift.shape[1]
+
+    for row in prange(out.shape[0]):
+        row_window = min(row // window_step, n_x - 1)
+
+        for col in range(out.shape[1]):
+            col_window = min(col // window_step, n_y - 1)
+
+            if (
+                row >= row_window * window_step + window_length
+                or col >= col_window * window_step + window_length
+            ):
+                out[row, col] = no_data
+            else:
+                out[row, col] = window_shift[row_window, col_window]
+
+
+def _find_shifts(reference_windows, moving_windows, upsample, normalize, subpixel):
+    """
+    Returns shift magnitude for each `(n_windows, rows, cols)` window pair
+
+    """
+    n_windows, rows, cols = reference_windows.shape
+
+    # Cross-power is formed in place over the reference spectrum
+    image_product = fft.rfftn(reference_windows, axes=(1, 2))
+    target_freq_conj = fft.rfftn(moving_windows, axes=(1, 2)).conj()
+    _cross_power(image_product, target_freq_conj, normalize)
+    cross_correlation = fft.irfftn(image_product, s=(rows, cols), axes=(1, 2))
+
+    shifts = np.empty((n_windows, 2), dtype=np.float64)
+    _peak_shifts(cross_correlation, shifts, subpixel and upsample <= 1)
+
+    return shift_magnitudes(shifts, image_product, rows, cols, upsample)
+
+
+def phase_cross_correlation(
+    reference_arr: np.ndarray,
+    moving_arr: np.ndarray,
+    window_size: int = 64,
+    window_step: int = 64,
+    no_data: float = -9999.0,
+    upsample: int = 1,
+    hann: bool = False,
+    normalize: bool = False,
+    subpixel: bool = False,
+    single_precision: bool = False,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Sliding window phase cross correlation of `reference_arr` against `moving_arr`
+    with `numba` kernels
+
+    Same windowing and results as the CPU kernel, written to `out` if given
+
+    """
+    x_max, y_max = reference_arr.shape
+    window_start = window_size // 2
+    dtype = SINGLE_DTYPE if single_precision else DTYPE
+
+    if out is None:
+        out = np.empty((x_max, y_max), dtype=np.float64)
+    elif out.shape != (x_max, y_max):
+        raise ValueError(f"`out` must be shaped {(x_max, y_max)}")
+
+    x_groups = window_groups(x_max, window_start, window_step)
+    y_groups = window_groups(y_max, window_start, window_step)
+
+    if not x_groups or not y_groups:
+        out[:] = no_data
+        return out
+
+    n_x = x_groups[-1][1]
+    n_y = y_groups[-1][1]
+
+    window_shift = np.empty((n_x, n_y), dtype=np.float64)
+
+    # Windows touching `no_data` in either image are never transformed
+    skip = no_data_windows(
+        (reference_arr, moving_arr), no_data, x_groups, y_groups, window_step
+    )
+
+    with fft.set_workers(FFT_WORKERS):
+        for rows, cols, x_len, y_len in window_batches(
+            x_groups, y_groups, MAX_BATCH_ELEMENTS
+        ):
+            shifts = window_shift[rows, cols]
+
+            keep = None
+            if skip is not None:
+                keep = ~skip[rows, cols]
+                shifts[~keep] = no_data
+                if not keep.any():
+                    continue
+
+            reference_stack = gather_windows(
+                strided_windows(reference_arr, rows, cols, x_len, y_len, window_step),
+                keep,
+                dtype,
+            )
+            moving_stack = gather_windows(
+                strided_windows(moving_arr, rows, cols, x_len, y_len, window_step),
+                keep,
+                dtype,
+            )
+
+            if hann:
+                taper = hann_window(x_len, y_len, dtype)
+                reference_stack *= taper
+                moving_stack *= taper
+
+            found = _find_shifts(
+                reference_stack, moving_stack, upsample, normalize, subpixel
+            )
+
+            if keep is None:
+                shifts[:] = found.reshape(shifts.shape)
+            else:
+                shifts[keep] = found
+
+    _gather_shifts(window_shift, out, window_step, 2 * window_start, no_data)
+
+    return out
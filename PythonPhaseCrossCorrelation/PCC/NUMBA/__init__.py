@@ -0,0 +1 @@
+from .OptimizedPhaseCrossCorrelation import phase_cross_correlation
@@ -7,9 +7,14 @@
 
 """
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from enum import Enum
 from enum import auto
+import multiprocessing
+import os
 from pathlib import Path
 import re
 from typing import Any
@@ -17,14 +22,83 @@ from typing import Optional
 from typing import Union
 import warnings
 
+from numba import njit
+from numba import prange
 import numpy as np
 
-from .CPU import phase_cross_correlation as pcc_cpu
+from .GPU import phase_cross_correlation as pcc_gpu
+from .NUMBA import phase_cross_correlation as pcc_numba
+
+# The CPU kernel must be compiled, `NUMBA` runs without it
+try:
+    from .CPU import clear_fft_cache
+    from .CPU import phase_cross_correlation as pcc_cpu
+    from .CPU import set_num_threads
+except ImportError:
+    clear_fft_cache = None
+    pcc_cpu = None
+    set_num_threads = None
+
+# Input dtypes the kernels take without conversion
+_KERNEL_DTYPES = (np.dtype(np.int16), np.dtype(np.float32), np.dtype(np.float64))
+
+# Characters stripped from output filenames
+_FILENAME_RE = re.compile(r"[^-\w.]", re.UNICODE)
+
+# GTiff creation options, tiled and compressed on all cores
+_GTIFF_OPTIONS = [
+    "TILED=YES",
+    "BLOCKXSIZE=256",
+    "BLOCKYSIZE=256",
+    "COMPRESS=DEFLATE",
+    "PREDICTOR=2",
+    "NUM_THREADS=ALL_CPUS",
+    "BIGTIFF=IF_SAFER",
+]
 
 
 class PCCMethods(Enum):
     CPU = auto()
     GPU = auto()
+    NUMBA = auto()
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _scale_clip(total_shift: np.ndarray, no_data: float, out: np.ndarray) -> float:
+    """
+    Scales `total_shift` by 1000 and clips to 32000 in one pass, writing into int16 `out`.
+    Returns the sum of `out`
+
+    """
+    total = 0.0
+    for row in prange(total_shift.shape[0]):
+        for col in range(total_shift.shape[1]):
+            value = total_shift[row, col]
+            if value == no_data:
+                out[row, col] = no_data
+            else:
+                value = 1000.0 * value
+                out[row, col] = 32000.0 if value > 32000.0 else value
+            total += out[row, col]
+    return total
+
+
+def _init_tile_worker(threads: int) -> None:
+    """
+    Limits each tile worker to its share of the host's cores
+
+    """
+    set_num_threads(threads)
+
+
+def _correlate_tile(
+    reference_tile: np.ndarray, moving_tile: np.ndarray, owned_rows: int, *pcc_args: Any
+) -> np.ndarray:
+    """
+    Runs the CPU kernel on one row tile, returning its first `owned_rows`
+
+    """
+    return pcc_cpu(reference_tile, moving_tile, *pcc_args)[:owned_rows]
 
 
 class PhaseCorrelationControl:
@@ -60,11 +134,29 @@ class PhaseCorrelationControl:
     `no_data` : float
         NODATA value for GDAl. Default `-9999.0`
     `method` : str or PCCMethods
-        Processing type - `CPU` or `GPU`. Default `CPU`
+        Processing type - `CPU`, `GPU` or `NUMBA`. Default `CPU`. `GPU` requires `cupy`,
+        `NUMBA` needs no compiled CPU kernel
     `reference_band` : int
         Reference band to read from `reference_img`. Default 1
     `moving_band` : int
         Moving band to read from `moving_img`. Default 1
+    `hann_window` : bool
+        If true, tapers each correlation window with a Hann window before the FFT. Default False
+    `normalize` : bool
+        If true, normalizes the cross-power spectrum to unit magnitude. Default False
+    `subpixel` : bool
+        If true, refines peaks with a parabolic fit. Far cheaper than `upsample`,
+        which takes precedence when > 1. Default False
+    `single_precision` : bool
+        If true, correlates in float32 / complex64. Faster, results may differ slightly. Default False
+    `n_tiles` : int
+        Number of row tiles processed in parallel worker processes, `CPU` only. Workers are
+        spawned and re-import the calling script, so scripts must guard their entry point
+        with `if __name__ == "__main__":`. Without one, workers die and the target area is
+        correlated untiled with a warning. Default 1
+    `cache_moving_spectra` : bool
+        If true, keeps moving image spectra for reuse against other references, `CPU`
+        without tiles only. See `clear_fft_cache()`. Default False
     `auto_save` : bool
         If true, saves results immediately to `outfile_dir`/`outfile_name`. False, does not
     `out_geo_transform` : tuple (valid geotransform)
@@ -79,6 +171,8 @@ class PhaseCorrelationControl:
     `save()`
         Save results from phase cross correlation. `out_geo_transform` and `out_projection_ref` must be
         manually given if `reference_img` and `moving_img` are given as np.ndarrays
+    `clear_fft_cache()`
+        Clear moving image spectra cached for reuse against other references
     """
 
     def __init__(
@@ -99,11 +193,31 @@ class PhaseCorrelationControl:
         method: Union[str, PCCMethods] = "CPU",
         reference_band: int = 1,
         moving_band: int = 1,
+        hann_window: bool = False,
+        normalize: bool = False,
+        subpixel: bool = False,
+        single_precision: bool = False,
+        n_tiles: int = 1,
+        cache_moving_spectra: bool = False,
         auto_save: bool = False,
         out_geo_transform: tuple = None,
         out_projection_ref: Any = None,
     ):
 
+        ##
+        # Validate `method` as str or PCCMethods Enum
+        ##
+        try:
+            self.method: PCCMethods = (
+                method
+                if isinstance(method, PCCMethods)
+                else PCCMethods[str(method).upper().strip()]
+            )
+        except KeyError:
+            raise AttributeError(
+                f"{method} not recognized. Select from {','.join(PCCMethods.__members__)}"
+            )
+
         ##
         # if NP arrays --> set
         # elif if given Path/str --> intake
@@ -115,6 +229,10 @@ class PhaseCorrelationControl:
             self.moving_path = None
             self.reference_path = None
 
+            self._full_shape: tuple = reference_img.shape
+            self._geo_transform: Optional[tuple] = out_geo_transform
+            self._projection_ref: Any = out_projection_ref
+
             if not out_geo_transform or not out_projection_ref:
                 warnings.warn(
                     "`out_geo_transform` and `out_projection_ref` not given - you are unable to `save()` results",
@@ -135,8 +253,49 @@ class PhaseCorrelationControl:
             self.reference_band = reference_band
             self.moving_band = moving_band
 
-            self.reference_arr = self._read_array(self.reference_path, reference_band)
-            self.moving_arr = self._read_array(self.moving_path, reference_band)
+            ##
+            # Compare raster sizes before reading any pixels,
+            # georeferencing is kept for `save()`
+            ##
+            reference_ds = self._open_raster(self.reference_path)
+            moving_ds = self._open_raster(self.moving_path)
+
+            self._full_shape: tuple = (
+                reference_ds.RasterYSize,
+                reference_ds.RasterXSize,
+            )
+            moving_shape: tuple = (moving_ds.RasterYSize, moving_ds.RasterXSize)
+
+            if self._full_shape != moving_shape:
+                raise ValueError(
+                    f"`reference_img` {self._full_shape} and `moving_img` {moving_shape} must be the same shape"
+                )
+
+            self._geo_transform: Optional[tuple] = reference_ds.GetGeoTransform()
+            self._projection_ref: Any = reference_ds.GetProjectionRef()
+
+            ##
+            # Decode both rasters concurrently, GDAL releases the GIL while reading
+            ##
+            window: dict = dict(
+                col_start=col_start,
+                col_end=col_end,
+                row_start=row_start,
+                row_end=row_end,
+            )
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                reference_future = executor.submit(
+                    self._read_array, reference_ds, reference_band, **window
+                )
+                moving_future = executor.submit(
+                    self._read_array, moving_ds, moving_band, **window
+                )
+
+                self.reference_arr = reference_future.result()
+                self.moving_arr = moving_future.result()
+
+            reference_ds = None
+            moving_ds = None
         else:
             raise ValueError(
                 "`reference_img` and `moving_img` must be given as a Path/str or np.ndaray"
@@ -149,45 +308,48 @@ class PhaseCorrelationControl:
             self.outfile_dir = self._valdiate_path(
                 outfile_dir, check_exists=True, check_is_file=False, check_is_dir=True
             )
-
-        ##
-        # Validate `method` as str or PCCMethods Enum
-        ##
-        for pcc_method in PCCMethods.__members__.values():
-            if method == pcc_method:
-                self.method = method
-                break
-            elif isinstance(method, str) and method.upper().strip() == pcc_method.name:
-                self.method = PCCMethods[method.upper().strip()]
-                break
-            else:
-                raise AttributeError(
-                    f"{method} not recognized. Select from {','.join([item.name for item in PCCMethods.__members__.values()])}"
-                )
+        else:
+            self.outfile_dir = Path(__file__).parent.absolute()
 
         self.outfile_name: str = self._get_valid_filename(outfile_name)
+
+        outfile_full_path: str = str(self.outfile_dir / self.outfile_name)
+        self.outfile_full_path: str = (
+            outfile_full_path
+            if outfile_full_path.endswith(".tif")
+            else outfile_full_path + ".tif"
+        )
+
         self.upsample: int = upsample
         self.col_start: int = col_start
         self.col_end: int = col_end
         self.row_start: int = row_start
         self.row_end: int = row_end
+        self._x0: int = col_start if col_start != -1 else 0
+        self._x1: int = col_end if col_end != -1 else self._full_shape[1]
+        self._y0: int = row_start if row_start != -1 else 0
+        self._y1: int = row_end if row_end != -1 else self._full_shape[0]
         self.window_size: int = window_size
         self.window_step: int = window_step
         self.outfile_driver: str = outfile_driver
         self.no_data: float = float(no_data)
+        self.hann_window: bool = hann_window
+        self.normalize: bool = normalize
+        self.subpixel: bool = subpixel
+        self.single_precision: bool = single_precision
+        self.n_tiles: int = n_tiles
+        self.cache_moving_spectra: bool = cache_moving_spectra
         self.auto_save: bool = auto_save
         self.out_geo_transform: tuple = out_geo_transform
         self.out_projection_ref: Any = out_projection_ref
         self.total_shift = None
+        self.total_shift_mean = None
 
         if self.upsample > 1 and self.method == PCCMethods.CPU:
             warnings.warn(
-                "CPU upsampling not implemented. Performance will be impacted", Warning
+                "CPU upsampling is slow. Consider `subpixel` instead", Warning
             )
 
-        if self.method.value == PCCMethods.GPU:
-            raise NotImplementedError("GPU not implemented. Use CPU")
-
         self.run()
 
     @staticmethod
@@ -229,11 +391,9 @@ class PhaseCorrelationControl:
         print(f"Complete in: {datetime.now() - start}")
 
     @staticmethod
-    def _read_array(
-        file: Union[str, Path], band: int = 1, dtype: str = "int16"
-    ) -> np.ndarray:
+    def _open_raster(file: Union[str, Path]) -> Any:
         """
-        Opens and extract array from `file` using `band` and `dtype`. Requires `gdal`
+        Opens `file` as a GDAL dataset. Requires `gdal`
 
         """
         try:
@@ -251,52 +411,174 @@ class PhaseCorrelationControl:
         if file_ds is None:
             raise FileNotFoundError("GDAL failed to open `file`")
 
-        file_arr: np.ndarray = np.array(
-            file_ds.GetRasterBand(band).ReadAsArray()
-        ).astype(dtype)
+        return file_ds
+
+    @staticmethod
+    def _read_array(
+        file_ds: Any,
+        band: int = 1,
+        dtype: str = "int16",
+        col_start: int = -1,
+        col_end: int = -1,
+        row_start: int = -1,
+        row_end: int = -1,
+    ) -> np.ndarray:
+        """
+        Extracts array from open dataset `file_ds` using `band` and `dtype`. Requires `gdal`
+
+        Only the window bounded by `col_start`, `col_end`, `row_start`, `row_end` is read,
+        `-1` meaning full extent. GDAL converts straight into a preallocated `dtype` buffer
 
-        file_ds = None
+        """
+        try:
+            import gdal_array
+        except ImportError:
+            print("`gdal` must be installed to read arrays")
+
+        x0: int = col_start if col_start != -1 else 0
+        x1: int = col_end if col_end != -1 else file_ds.RasterXSize
+        y0: int = row_start if row_start != -1 else 0
+        y1: int = row_end if row_end != -1 else file_ds.RasterYSize
+
+        if gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype)) is None:
+            raise ValueError(f"GDAL cannot read into `dtype` {dtype}")
+
+        file_arr: np.ndarray = np.empty((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=dtype)
+
+        read_arr = file_ds.GetRasterBand(band).ReadAsArray(
+            xoff=x0,
+            yoff=y0,
+            win_xsize=x1 - x0,
+            win_ysize=y1 - y0,
+            buf_obj=file_arr,
+        )
+
+        if read_arr is None:
+            raise ValueError(f"Window ({x0}, {y0}, {x1}, {y1}) is outside of `file`")
 
         return file_arr
 
     def _process_arrays(self):
         """
-        Extracts target area from `reference_arr` and `moving_arr`
+        Extracts target area from `reference_arr` and `moving_arr` as contiguous arrays.
+        Arrays read from file are already windowed to the target area.
+        int16, float32 and float64 pass through, other dtypes become float32
 
         """
 
         if self.reference_arr.shape != self.moving_arr.shape:
             raise ValueError("`reference_arr` and `moving_arr` must be the same shape")
 
-        self.reference_arr = self.reference_arr[
-            self.y0 : self.y1, self.x0 : self.x1
-        ].astype("intc")
+        if self.reference_path is None:
+            self.reference_arr = self.reference_arr[
+                self.y0 : self.y1, self.x0 : self.x1
+            ]
+            self.moving_arr = self.moving_arr[self.y0 : self.y1, self.x0 : self.x1]
 
-        self.moving_arr = self.moving_arr[self.y0 : self.y1, self.x0 : self.x1].astype(
-            "intc"
-        )
+        dtype = self.reference_arr.dtype
+        if dtype not in _KERNEL_DTYPES or dtype != self.moving_arr.dtype:
+            dtype = np.float32
+
+        self.reference_arr = np.ascontiguousarray(self.reference_arr, dtype=dtype)
+        self.moving_arr = np.ascontiguousarray(self.moving_arr, dtype=dtype)
 
     def _process_correlation(self):
+        total_shift = np.empty(self.reference_arr.shape, dtype=np.float64)
+
         if self.method == PCCMethods.CPU:
-            total_shift = pcc_cpu(
-                self.reference_arr,
-                self.moving_arr,
-                self.window_size,
-                self.window_step,
-                self.no_data,
-                self.upsample,
-            )
+            if pcc_cpu is None:
+                raise ImportError(
+                    "CPU kernel is not compiled. Build `PCC/CPU` or use method `NUMBA`"
+                )
+            if self.n_tiles > 1:
+                self._tile_dispatch(self.n_tiles, total_shift)
+            else:
+                pcc_cpu(
+                    self.reference_arr,
+                    self.moving_arr,
+                    *self._pcc_args,
+                    cache_moving_spectra=self.cache_moving_spectra,
+                    out=total_shift,
+                )
         elif self.method == PCCMethods.GPU:
-            raise NotImplementedError("GPU not implemented")
+            pcc_gpu(
+                self.reference_arr, self.moving_arr, *self._pcc_args, out=total_shift
+            )
+        elif self.method == PCCMethods.NUMBA:
+            pcc_numba(
+                self.reference_arr, self.moving_arr, *self._pcc_args, out=total_shift
+            )
         else:
-            raise AttributeError("`method` must be `CPU` or `GPU`")
+            raise AttributeError("`method` must be `CPU`, `GPU` or `NUMBA`")
+
+        self.total_shift = np.empty(total_shift.shape, dtype=np.int16)
+        total: float = _scale_clip(total_shift, self.no_data, self.total_shift)
 
-        total_shift = np.where(
-            total_shift != self.no_data, 1000.0 * total_shift, self.no_data
+        # Mean of the saved int16 raster, `nan` for an empty target area
+        self.total_shift_mean = (
+            total / self.total_shift.size if self.total_shift.size else np.nan
         )
-        total_shift = np.where(total_shift > 32000, 32000, total_shift)
 
-        self.total_shift = total_shift
+    def _tile_dispatch(self, n_tiles: int, out: np.ndarray) -> None:
+        """
+        Splits the target area into `n_tiles` row tiles and correlates them in worker processes
+        into `out`
+
+        Tiles break on window rows and extend one window past the break so seam windows
+        stay whole. Overlap rows are trimmed before stitching, so results match a single run.
+        Each worker is sent only its own rows and limited to its share of the cores.
+        Workers are spawned, not forked, as numba's threading layer is not fork-safe.
+        If the pool breaks, e.g. a calling script without a `__main__` guard, falls back to
+        one untiled run
+
+        """
+        rows: int = self.reference_arr.shape[0]
+        window_start: int = self.window_size // 2
+        n_windows: int = len(range(window_start, rows, self.window_step))
+
+        if n_windows <= 1 or n_tiles <= 1:
+            pcc_cpu(self.reference_arr, self.moving_arr, *self._pcc_args, out=out)
+            return
+
+        overlap: int = max(2 * window_start - self.window_step, 0)
+        n_tiles = min(n_tiles, n_windows)
+        bounds = np.linspace(0, n_windows, n_tiles + 1).astype(int)
+
+        cpu_count: int = os.cpu_count() or 1
+        max_workers: int = min(n_tiles, cpu_count)
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_tile_worker,
+                initargs=(max(cpu_count // max_workers, 1),),
+            ) as executor:
+                tiles = []
+                for first, last in zip(bounds[:-1], bounds[1:]):
+                    row_start = first * self.window_step
+                    owned_end = rows if last == n_windows else last * self.window_step
+                    row_end = min(owned_end + overlap, rows)
+
+                    future = executor.submit(
+                        _correlate_tile,
+                        self.reference_arr[row_start:row_end],
+                        self.moving_arr[row_start:row_end],
+                        owned_end - row_start,
+                        *self._pcc_args,
+                    )
+                    tiles.append((row_start, owned_end, future))
+
+                for row_start, owned_end, future in tiles:
+                    out[row_start:owned_end] = future.result()
+
+        except BrokenProcessPool:
+            warnings.warn(
+                "Tile workers failed to start, correlating untiled. Guard the calling "
+                'script with `if __name__ == "__main__":` to use `n_tiles`',
+                Warning,
+            )
+            pcc_cpu(self.reference_arr, self.moving_arr, *self._pcc_args, out=out)
 
     def save(self):
         """
@@ -310,6 +592,11 @@ class PhaseCorrelationControl:
         except ImportError:
             print("`gdal` must be installed to read arrays")
 
+        if self._geo_transform is None or self._projection_ref is None:
+            raise ValueError(
+                "`reference_path` or `moving_path` or (`out_geo_transform` and `out_projection_ref`) must exist to `save()` results"
+            )
+
         out_driver = gdal.GetDriverByName(self.outfile_driver)
         out_ds = out_driver.Create(
             self.outfile_full_path,
@@ -317,51 +604,38 @@ class PhaseCorrelationControl:
             self.total_shift.shape[0],
             1,
             gdalconst.GDT_Int16,
+            options=_GTIFF_OPTIONS if self.outfile_driver == "GTiff" else [],
         )
 
-        geo_transform: tuple
-        projection_ref: Any
-        if self.reference_path is not None or self.moving_path is not None:
-            reference_ds = gdal.Open(
-                str(
-                    self.reference_path
-                    if self.reference_path is not None
-                    else self.moving_path
-                )
-            )
-            geo_transform = reference_ds.GetGeoTransform()
-            projection_ref = reference_ds.GetProjectionRef()
-            reference_ds = None
-        elif self.out_geo_transform is None or self.out_projection_ref is None:
-            raise ValueError(
-                "`reference_path` or `moving_path` or (`out_geo_transform` and `out_projection_ref`) must exist to `save()` results"
-            )
-        else:
-            geo_transform = self.out_geo_transform
-            projection_ref = self.out_projection_ref
-
-        x_offset = geo_transform[0] + geo_transform[1] * self.x0
-        y_offset = geo_transform[3] + geo_transform[5] * self.y0
-
-        geo_transform_subset: tuple = tuple(
-            [
-                x_offset,
-                geo_transform[1],
-                geo_transform[2],
-                y_offset,
-                geo_transform[4],
-                geo_transform[5],
-            ]
+        geo_transform: tuple = self._geo_transform
+        projection_ref: Any = self._projection_ref
+
+        geo_transform_subset: tuple = (
+            geo_transform[0] + geo_transform[1] * self._x0,
+            geo_transform[1],
+            geo_transform[2],
+            geo_transform[3] + geo_transform[5] * self._y0,
+            geo_transform[4],
+            geo_transform[5],
         )
 
         out_ds.SetGeoTransform(geo_transform_subset)
         out_ds.SetProjection(projection_ref)
-        out_ds.GetRasterBand(1).WriteArray(self.total_shift.astype("int16"))
+        out_ds.GetRasterBand(1).WriteArray(self.total_shift)
         out_ds.GetRasterBand(1).SetNoDataValue(self.no_data)
 
         out_ds = None
 
-        print(np.mean(self.total_shift))
+        print(self.total_shift_mean)
+
+    @staticmethod
+    def clear_fft_cache() -> None:
+        """
+        Clears moving image spectra cached by the CPU kernel
+
+        """
+        if clear_fft_cache is not None:
+            clear_fft_cache()
 
     @staticmethod
     def _get_valid_filename(name: str) -> str:
@@ -370,26 +644,39 @@ class PhaseCorrelationControl:
 
         """
         washed = name.strip().replace(" ", "_")
-        washed = re.sub(r"(?u)[^-\w.]", "", washed)
+        washed = _FILENAME_RE.sub("", washed)
         if washed in {"", ".", ".."}:
             raise ValueError(f"Could not sanitize ouput name {name}")
         return washed
 
     @property
     def x0(self) -> int:
-        return self.col_start if self.col_start != -1 else 0
+        return self._x0
 
     @property
     def x1(self) -> int:
-        return self.col_end if self.col_end != -1 else self.reference_shape_row
+        return self._x1
 
     @property
     def y0(self) -> int:
-        return self.row_start if self.row_start != -1 else 0
+        return self._y0
 
     @property
     def y1(self) -> int:
-        return self.row_end if self.row_end != -1 else self.reference_shape_col
+        return self._y1
+
+    @property
+    def _pcc_args(self) -> tuple:
+        return (
+            self.window_size,
+            self.window_step,
+            self.no_data,
+            self.upsample,
+            self.hann_window,
+            self.normalize,
+            self.subpixel,
+            self.single_precision,
+        )
 
     @property
     def moving_shape(self) -> tuple:
@@ -406,13 +693,3 @@ class PhaseCorrelationControl:
     @property
     def reference_shape_col(self) -> int:
         return self.reference_arr.shape[0]
-
-    @property
-    def outfile_full_path(self) -> str:
-
-        full_name: str = str(self.outfile_dir / self.outfile_name)
-
-        if not full_name.endswith(".tif"):
-            full_name = full_name + ".tif"
-
-        return full_name
@@ -0,0 +1,248 @@
+"""
+Window layout, batching and spectrum helpers shared by the CPU, GPU and
+NUMBA kernels. Array helpers take the array module as `xp`, `numpy` or `cupy`
+
+"""
+
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+
+# Hann tapers cached by window shape and dtype
+HANN_WINDOWS: Dict[tuple, np.ndarray] = {}
+
+
+def window_groups(
+    axis_max: int, window_start: int, window_step: int
+) -> List[Tuple[int, int, int]]:
+    """
+    Groups window indices along one axis by window length
+
+    Windows are centered on `range(window_start, axis_max, window_step)`. Full
+    windows share one group; windows truncated by the array edge each get
+    their own. Returns `(first_index, last_index, window_length)` tuples
+
+    """
+    n_windows = len(range(window_start, axis_max, window_step))
+    window_length = 2 * window_start
+    n_full = 0
+
+    if axis_max >= window_length:
+        n_full = min(n_windows, (axis_max - window_length) // window_step + 1)
+
+    groups = [(0, n_full, window_length)] if n_full > 0 else []
+    for idx in range(n_full, n_windows):
+        groups.append((idx, idx + 1, axis_max - idx * window_step))
+
+    return groups
+
+
+def window_batches(
+    x_groups: List[Tuple[int, int, int]],
+    y_groups: List[Tuple[int, int, int]],
+    max_elements: int,
+) -> Iterator[Tuple[slice, slice, int, int]]:
+    """
+    Yields `(rows, cols, x_len, y_len)` batches of equally sized windows
+
+    `rows` and `cols` slice window indices. Each batch spans whole window rows
+    and holds at most `max_elements` pixels, one window row at minimum
+
+    """
+    for x_first, x_last, x_len in x_groups:
+        for y_first, y_last, y_len in y_groups:
+            chunk_rows = max(1, max_elements // ((y_last - y_first) * x_len * y_len))
+
+            for chunk_start in range(x_first, x_last, chunk_rows):
+                yield (
+                    slice(chunk_start, min(chunk_start + chunk_rows, x_last)),
+                    slice(y_first, y_last),
+                    x_len,
+                    y_len,
+                )
+
+
+def strided_windows(
+    arr, rows: slice, cols: slice, x_len: int, y_len: int, window_step: int, xp=np
+):
+    """
+    Returns a `(n_rows, n_cols, x_len, y_len)` view of the windows of `arr` at
+    window indices `rows`, `cols`
+
+    """
+    origin = arr[rows.start * window_step :, cols.start * window_step :]
+    row_stride, col_stride = arr.strides
+
+    return xp.lib.stride_tricks.as_strided(
+        origin,
+        shape=(rows.stop - rows.start, cols.stop - cols.start, x_len, y_len),
+        strides=(
+            row_stride * window_step,
+            col_stride * window_step,
+            row_stride,
+            col_stride,
+        ),
+    )
+
+
+def gather_windows(windows, keep, dtype, xp=np):
+    """
+    Copies `(n_x, n_y, rows, cols)` `windows` into a contiguous
+    `(n_windows, rows, cols)` stack of `dtype`, only those flagged in `keep` if given
+
+    """
+    if keep is not None:
+        windows = windows[keep]
+
+    return xp.ascontiguousarray(windows, dtype=dtype).reshape(-1, *windows.shape[-2:])
+
+
+def hann_window(rows: int, cols: int, dtype) -> np.ndarray:
+    """
+    Returns the cached 2D Hann taper for `(rows, cols)` windows of `dtype`
+
+    """
+    key = (rows, cols, np.dtype(dtype).str)
+    if key not in HANN_WINDOWS:
+        HANN_WINDOWS[key] = np.outer(np.hanning(rows), np.hanning(cols)).astype(dtype)
+
+    return HANN_WINDOWS[key]
+
+
+def window_bounds(
+    groups: List[Tuple[int, int, int]], window_step: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns per-window `(start, end)` index arrays along one axis of `groups`
+
+    """
+    lengths = np.concatenate(
+        [np.full(last - first, length) for first, last, length in groups]
+    )
+    start = np.arange(lengths.shape[0]) * window_step
+
+    return start, start + lengths
+
+
+def no_data_windows(
+    arrays: Sequence[np.ndarray],
+    no_data: float,
+    x_groups: List[Tuple[int, int, int]],
+    y_groups: List[Tuple[int, int, int]],
+    window_step: int,
+) -> Optional[np.ndarray]:
+    """
+    Flags `(n_x, n_y)` windows holding any `no_data` pixel in any of `arrays`,
+    `None` if no array has one
+
+    Each count is four lookups into an integral image of the `no_data` mask
+
+    """
+    x_start, x_end = window_bounds(x_groups, window_step)
+    y_start, y_end = window_bounds(y_groups, window_step)
+    x_start = x_start[:, None]
+    x_end = x_end[:, None]
+
+    flags = None
+    for arr in arrays:
+        mask = arr == no_data
+        if not mask.any():
+            continue
+
+        integral = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype=np.int32)
+        np.cumsum(mask, axis=0, out=integral[1:, 1:])
+        np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+
+        counts = (
+            integral[x_end, y_end]
+            - integral[x_start, y_end]
+            - integral[x_end, y_start]
+            + integral[x_start, y_start]
+        )
+
+        flags = counts > 0 if flags is None else flags | (counts > 0)
+
+    return flags
+
+
+def upsampled_dft(image_product, upsampled_region_size, upsample, axis_offsets, xp=np):
+    """
+    Batched upsampled DFT by matrix multiplication
+
+    `image_product` is `(n_windows, rows, cols)`, `axis_offsets` is `(n_windows, 2)`.
+    See the CPU module for references
+
+    """
+    im2pi = 1j * 2 * np.pi
+    region = xp.arange(upsampled_region_size)
+
+    row_kernel = xp.exp(
+        -im2pi
+        * (region[None, :] - axis_offsets[:, 0, None])[:, :, None]
+        * xp.fft.fftfreq(image_product.shape[1], upsample)
+    )
+    col_kernel = xp.exp(
+        -im2pi
+        * (region[None, :] - axis_offsets[:, 1, None])[:, :, None]
+        * xp.fft.fftfreq(image_product.shape[2], upsample)
+    )
+
+    return row_kernel @ image_product @ col_kernel.transpose(0, 2, 1)
+
+
+def full_spectrum(half_spectrum, cols: int, xp=np):
+    """
+    Rebuilds the full 2D spectrum of real windows from their `rfftn` half
+
+    """
+    tail = half_spectrum[:, :, 1 : (cols + 1) // 2][:, ::-1, ::-1].conj()
+
+    return xp.concatenate((half_spectrum, xp.roll(tail, 1, axis=1)), axis=2)
+
+
+def shift_magnitudes(shifts, image_product, rows: int, cols: int, upsample: int, xp=np):
+    """
+    Returns the magnitude of each integer or parabolic `(n_windows, 2)` peak in
+    `shifts`, refined on the upsampled DFT of the `rfftn` half `image_product`
+    if `upsample > 1`
+
+    Shifts along unit-length window axes are zeroed
+
+    """
+    if upsample > 1:
+
+        shifts = xp.round(shifts * upsample) / upsample
+        upsampled_region_size = int(np.ceil(upsample * 1.5))
+
+        dftshift = np.fix(upsampled_region_size / 2.0)
+
+        cross_correlation = upsampled_dft(
+            full_spectrum(image_product, cols, xp=xp).conj(),
+            upsampled_region_size,
+            upsample,
+            dftshift - shifts * upsample,
+            xp=xp,
+        )
+
+        maxima = xp.abs(cross_correlation).reshape(shifts.shape[0], -1).argmax(axis=1)
+        maxima = (
+            xp.stack(
+                (maxima // upsampled_region_size, maxima % upsampled_region_size),
+                axis=1,
+            ).astype(xp.float64)
+            - dftshift
+        )
+
+        shifts = shifts + maxima / upsample
+
+    if rows == 1:
+        shifts[:, 0] = 0
+    if cols == 1:
+        shifts[:, 1] = 0
+
+    return xp.sqrt(shifts[:, 1] * shifts[:, 1] + shifts[:, 0] * shifts[:, 0])
@@ -13,7 +13,7 @@ from typing import Optional
 import typer
 
 from PCC import PhaseCorrelationControl
-# from PCC.PhaseCorrelationControl import PCCMethods
+from PCC.PhaseCorrelationControl import PCCMethods
 
 
 app = typer.Typer()
@@ -37,6 +37,14 @@ def upsample_callback(value: int) -> int:
     return value
 
 
+def method_callback(value: str) -> str:
+    if value.upper().strip() not in PCCMethods.__members__:
+        raise typer.BadParameter(
+            f"Method must be one of {','.join(PCCMethods.__members__)}"
+        )
+    return value
+
+
 @app.command()
 def main(
     reference_path: Path = typer.Argument(
@@ -133,13 +141,26 @@ def main(
         "-up",
         help="Register image within 1 / n of a pixel",
         callback=upsample_callback,
-    )
-    # method: PCCMethods = typer.Option(
-    #     PCCMethods.CPU,
-    #     "--method",
-    #     "-m",
-    #     help="Compute method for PCC",
-    # ),
+    ),
+    subpixel: bool = typer.Option(
+        False,
+        "--subpixel",
+        "-sp",
+        help="Refine correlation peaks with a parabolic fit",
+    ),
+    single_precision: bool = typer.Option(
+        False,
+        "--single-precision",
+        "-sgl",
+        help="Correlate in float32 for speed",
+    ),
+    method: str = typer.Option(
+        "CPU",
+        "--method",
+        "-m",
+        help="Compute method for PCC - CPU, GPU (requires cupy) or NUMBA",
+        callback=method_callback,
+    ),
 ):
     PhaseCorrelationControl(
         reference_path,
@@ -153,7 +174,9 @@ def main(
         window_size=window_size,
         window_step=window_step,
         upsample=upsample,
-        method="CPU",
+        subpixel=subpixel,
+        single_precision=single_precision,
+        method=method,
         auto_save=True,
     )
 
@@ -30,6 +30,8 @@ TEST_OUTFILE_NAME: str = "TEST_FILE.tif"
 TEST_SUITE: List[dict] = [
     {"upsample": 1, "mean": 126.266904},
     {"upsample": 100, "mean": 244.066272},
+    {"upsample": 1, "method": "NUMBA", "mean": 126.266904},
+    {"upsample": 100, "method": "NUMBA", "mean": 244.066272},
 ]
 
 
@@ -59,6 +61,8 @@ def test_app():
                 TEST_OUTFILE_NAME,
                 "--upsample",
                 test["upsample"],
+                "--method",
+                test.get("method", "CPU"),
             ],
         )
 
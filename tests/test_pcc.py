@@ -0,0 +1,179 @@
+"""
+Tests for the CPU and NUMBA phase cross correlation kernels
+
+"""
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from PythonPhaseCrossCorrelation.PCC import PhaseCorrelationControl
+from PythonPhaseCrossCorrelation.PCC.NUMBA import (
+    phase_cross_correlation as pcc_numba,
+)
+
+try:
+    from PythonPhaseCrossCorrelation.PCC.CPU import OptimizedPhaseCrossCorrelation
+    from PythonPhaseCrossCorrelation.PCC.CPU import clear_fft_cache
+    from PythonPhaseCrossCorrelation.PCC.CPU import (
+        phase_cross_correlation as pcc_cpu,
+    )
+except ImportError:
+    pcc_cpu = None
+
+
+NO_DATA: float = -9999.0
+
+KERNELS: list = [
+    pytest.param(pcc_numba, id="NUMBA"),
+    pytest.param(
+        pcc_cpu,
+        id="CPU",
+        marks=pytest.mark.skipif(pcc_cpu is None, reason="CPU kernel not compiled"),
+    ),
+]
+
+
+def make_pair(shape: tuple, shift: tuple, seed: int = 0) -> tuple:
+
+    rng = np.random.default_rng(seed)
+    reference_arr: np.ndarray = rng.integers(0, 3000, shape).astype("int16")
+    moving_arr: np.ndarray = np.roll(reference_arr, shift, axis=(0, 1))
+
+    return reference_arr, moving_arr
+
+
+def expected_no_data(
+    reference_arr: np.ndarray,
+    moving_arr: np.ndarray,
+    window_size: int,
+    window_step: int,
+) -> np.ndarray:
+    """
+    Brute force `no_data` mask - each pixel takes its covering window, the last one wins
+
+    """
+    rows, cols = reference_arr.shape
+    window_start: int = window_size // 2
+    n_x: int = len(range(window_start, rows, window_step))
+    n_y: int = len(range(window_start, cols, window_step))
+
+    expected: np.ndarray = np.zeros(reference_arr.shape, dtype=bool)
+    for row in range(rows):
+        row_start: int = min(row // window_step, n_x - 1) * window_step
+        for col in range(cols):
+            col_start: int = min(col // window_step, n_y - 1) * window_step
+
+            if row >= row_start + window_size or col >= col_start + window_size:
+                expected[row, col] = True
+                continue
+
+            footprint = (
+                slice(row_start, row_start + window_size),
+                slice(col_start, col_start + window_size),
+            )
+            expected[row, col] = np.any(reference_arr[footprint] == NO_DATA) or np.any(
+                moving_arr[footprint] == NO_DATA
+            )
+
+    return expected
+
+
+@pytest.mark.parametrize("kernel", KERNELS)
+def test_no_data_windows(kernel):
+
+    reference_arr, moving_arr = make_pair((123, 101), (2, 1))
+
+    rng = np.random.default_rng(1)
+    for arr in (reference_arr, moving_arr):
+        arr[rng.integers(0, 123, 6), rng.integers(0, 101, 6)] = NO_DATA
+
+    total_shift = kernel(reference_arr, moving_arr, 16, 8, NO_DATA)
+
+    expected = expected_no_data(reference_arr, moving_arr, 16, 8)
+    assert expected.any() and not expected.all()
+    assert np.array_equal(total_shift == NO_DATA, expected)
+
+
+@pytest.mark.parametrize("kernel", KERNELS)
+def test_subpixel(kernel):
+
+    ##
+    # Periodic tiles, so each window holds an exact fractional circular shift
+    ##
+    rng = np.random.default_rng(0)
+    tile = ndimage.gaussian_filter(rng.random((64, 64)), 4, mode="wrap") * 1000
+    shifted_tile = np.fft.ifft2(
+        ndimage.fourier_shift(np.fft.fft2(tile), (0.3, -0.4))
+    ).real
+
+    reference_arr = np.tile(tile, (2, 2))
+    moving_arr = np.tile(shifted_tile, (2, 2))
+
+    for upsample in (0, 1):
+        total_shift = kernel(
+            reference_arr, moving_arr, 64, 64, NO_DATA, upsample, subpixel=True
+        )
+        assert np.allclose(total_shift, 0.5, atol=0.05)
+
+    total_shift = kernel(reference_arr, moving_arr, 64, 64, NO_DATA)
+    assert not np.allclose(total_shift, 0.5, atol=0.05)
+
+
+@pytest.mark.skipif(pcc_cpu is None, reason="CPU kernel not compiled")
+def test_tiles():
+
+    reference_arr, moving_arr = make_pair((300, 140), (3, -2))
+
+    results: list = [
+        PhaseCorrelationControl(
+            reference_arr,
+            moving_arr,
+            window_size=32,
+            window_step=6,
+            n_tiles=n_tiles,
+            out_geo_transform=(0, 1, 0, 0, 0, -1),
+            out_projection_ref='LOCAL_CS["test"]',
+        ).total_shift
+        for n_tiles in (1, 3)
+    ]
+
+    assert np.array_equal(results[0], results[1])
+
+
+@pytest.mark.skipif(pcc_cpu is None, reason="CPU kernel not compiled")
+@pytest.mark.parametrize("with_no_data", [False, True])
+@pytest.mark.parametrize("single_precision", [False, True])
+def test_cached_moving_spectra(with_no_data, single_precision):
+
+    ##
+    # One moving raster against two references, with and without the cache
+    ##
+    reference_arr, moving_arr = make_pair((150, 130), (2, -3))
+    other_reference_arr, _ = make_pair((150, 130), (0, 0), seed=1)
+
+    if with_no_data:
+        rng = np.random.default_rng(2)
+        moving_arr[rng.integers(0, 150, 4), rng.integers(0, 130, 4)] = NO_DATA
+        reference_arr[rng.integers(0, 150, 4), rng.integers(0, 130, 4)] = NO_DATA
+
+    clear_fft_cache()
+    for reference in (reference_arr, other_reference_arr, reference_arr):
+        expected = pcc_cpu(
+            reference, moving_arr, 32, 16, NO_DATA, single_precision=single_precision
+        )
+        cached = pcc_cpu(
+            reference,
+            moving_arr,
+            32,
+            16,
+            NO_DATA,
+            single_precision=single_precision,
+            cache_moving_spectra=True,
+        )
+        assert np.array_equal(cached, expected)
+
+    assert len(OptimizedPhaseCrossCorrelation.MOVING_SPECTRA_CACHE) == 1
+
+    clear_fft_cache()
+    assert not OptimizedPhaseCrossCorrelation.MOVING_SPECTRA_CACHE